@@ -7,16 +7,25 @@ Domain Firewall Check API
 """
 
 import socket
+import re
 import ssl
-import subprocess
 import asyncio
-import concurrent.futures
-from fastapi import FastAPI, Query, HTTPException
+import contextlib
+from collections import OrderedDict
+from fastapi import FastAPI, Query, HTTPException, Request
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
 from typing import Optional, Union
 import time
 
+try:
+    import aiodns
+except ImportError:  # 未安装 aiodns 时回退到 dig 子进程
+    aiodns = None
+
 # -----------------------
 # 配置区域
 # -----------------------
@@ -25,15 +34,48 @@ TEST_DNS = {
     "Google(8.8.8.8)": "8.8.8.8",
     "Cloudflare(1.1.1.1)": "1.1.1.1",
     "Ali(223.5.5.5)": "223.5.5.5",
-    "114DNS(114.114.114.114)": "114.114.114.114"
+    "114DNS(114.114.114.114)": "114.114.114.114",
+    "System(本机)": None
 }
 
-TEST_PORTS = [80, 443]
+TEST_PORTS = (80, 443)
 
 TIMEOUT = 4
 
-# 线程池用于执行阻塞操作
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=20)
+# 每个客户端 IP 的检测频率限制
+RATE_LIMIT = "10/minute"
+
+# 单次检测最多测试的 IP 数量
+MAX_PROBE_IPS = 16
+
+# 域名格式（IDNA 编码后校验）
+_DOMAIN_RE = re.compile(
+    r"^(?=.{1,253}$)(?!-)[A-Za-z0-9-]{1,63}(?<!-)(\.(?!-)[A-Za-z0-9-]{1,63}(?<!-))+$"
+)
+
+# DNS 缓存：最大条目数、失败结果缓存时间、dig 回退时的默认 TTL（秒）
+DNS_CACHE_SIZE = 1024
+DNS_ERROR_TTL = 0.15
+DNS_FALLBACK_TTL = 60
+
+# TLS 会话缓存：最大条目数、等待 TLS 1.3 会话票据的时间（秒）
+TLS_SESSION_CACHE_SIZE = 1024
+TLS_TICKET_WAIT = 0.2
+
+# TLS 上下文（创建时需加载系统 CA 证书，全局复用）
+_TLS_CTX = ssl.create_default_context()
+
+# TLS 会话缓存（LRU）：domain -> SSLSession，用于后续握手的会话恢复
+_tls_sessions = OrderedDict()
+
+# 每个 DNS 服务器对应一个 aiodns 解析器，便于并发查询
+_resolvers = {}
+
+# DNS 结果缓存（LRU）：(domain, dns) -> (过期时间, IP 列表)
+_dns_cache = OrderedDict()
+
+# 进行中的检测：(domain, thorough) -> Future，相同的并发请求共享同一次检测
+_inflight = {}
 
 # -----------------------
 # FastAPI 应用
@@ -45,6 +87,11 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# 每次检测会发起大量 DNS / TCP / TLS / HTTP 探测，按客户端 IP 限制频率
+limiter = Limiter(key_func=get_remote_address)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
 
 # -----------------------
 # 请求模型
@@ -52,99 +99,337 @@ app = FastAPI(
 
 class DomainRequest(BaseModel):
     domain: str
+    thorough: bool = False
 
 
 # -----------------------
-# 工具函数（同步版本，在线程池中执行）
+# 异步工具函数
 # -----------------------
 
-def dig_query(domain: str, dns: str) -> list:
-    """DNS 查询"""
+def normalize_domain(domain: str) -> Optional[str]:
+    """校验并规范化域名（国际化域名转为小写 IDNA/ASCII 形式），格式不正确时返回 None"""
+    domain = domain.lower()
+    if domain.endswith("."):
+        domain = domain[:-1]
     try:
-        result = subprocess.check_output(
-            ["dig", "+short", domain, f"@{dns}"],
-            stderr=subprocess.STDOUT,
-            timeout=TIMEOUT
-        ).decode().strip().split("\n")
-        return [r for r in result if r and r.strip()]
+        ascii_domain = domain.encode("idna").decode("ascii")
+        # 内置 idna 编解码器遵循 IDNA2003，会把 ß、ς 等字符改写成其他字母（ß.de → ss.de），
+        # 非 ASCII 标签转换后无法还原为原输入的直接拒绝，避免检测到另一个域名
+        for label, ascii_label in zip(domain.split("."), ascii_domain.split(".")):
+            if not label.isascii() and ascii_label.encode("ascii").decode("idna") != label:
+                return None
+    except Exception:
+        return None
+    return ascii_domain if _DOMAIN_RE.match(ascii_domain) else None
+
+
+def get_resolver(dns: str) -> "aiodns.DNSResolver":
+    """获取（或创建）指定 DNS 服务器的解析器"""
+    resolver = _resolvers.get(dns)
+    if resolver is None:
+        resolver = aiodns.DNSResolver(nameservers=[dns], timeout=TIMEOUT, tries=1)
+        _resolvers[dns] = resolver
+    return resolver
+
+
+def dns_cache_get(domain: str, dns: str) -> Optional[list]:
+    """读取未过期的 DNS 缓存"""
+    key = (domain, dns)
+    entry = _dns_cache.get(key)
+    if entry is None:
+        return None
+    expiry, ips = entry
+    if expiry <= time.monotonic():
+        _dns_cache.pop(key, None)
+        return None
+    _dns_cache.move_to_end(key)
+    return ips
+
+
+def dns_cache_set(domain: str, dns: str, ips: list, ttl: float):
+    """写入 DNS 缓存，超出容量时淘汰最久未使用的条目"""
+    key = (domain, dns)
+    _dns_cache[key] = (time.monotonic() + ttl, ips)
+    _dns_cache.move_to_end(key)
+    while len(_dns_cache) > DNS_CACHE_SIZE:
+        _dns_cache.popitem(last=False)
+
+
+async def dig_query(domain: str, dns: str) -> list:
+    """DNS 查询（dig 子进程，未安装 aiodns 时使用）"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "dig", "+short", domain, f"@{dns}",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
     except Exception:
         return []
 
-
-def tcp_connect(ip: str, port: int) -> bool:
-    """TCP 连接测试"""
     try:
-        with socket.create_connection((ip, port), timeout=TIMEOUT):
-            return True
+        output, _ = await asyncio.wait_for(proc.communicate(), TIMEOUT)
     except Exception:
-        return False
+        return []
+    finally:
+        # 超时或被取消（DNS 检测提前结束）时结束 dig 进程
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+
+    result = output.decode().strip().split("\n")
+    return [r for r in result if r and r.strip()]
 
 
-def tls_handshake(domain: str) -> Union[str, bool]:
-    """TLS 握手测试"""
+async def system_query(domain: str) -> list:
+    """系统解析器查询（getaddrinfo，反映本机实际解析结果；只取 IPv4，与其他 DNS 的 A 记录可比）"""
+    loop = asyncio.get_running_loop()
     try:
-        ctx = ssl.create_default_context()
-        with ctx.wrap_socket(socket.socket(), server_hostname=domain) as s:
-            s.settimeout(TIMEOUT)
-            s.connect((domain, 443))
-            s.do_handshake()
-        return True
-    except ssl.SSLError:
-        return "TLS-Reset"
+        infos = await asyncio.wait_for(
+            loop.getaddrinfo(domain, 443, family=socket.AF_INET, type=socket.SOCK_STREAM),
+            TIMEOUT
+        )
     except Exception:
-        return False
+        return []
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+
+async def async_dig_query(domain: str, dns: Optional[str]) -> tuple[Optional[str], list]:
+    """异步 DNS 查询（直接向 DNS 服务器发送 UDP A 记录查询，按 TTL 缓存；dns 为 None 时使用系统解析器）"""
+    if dns is None:
+        return dns, await system_query(domain)
 
+    ips = dns_cache_get(domain, dns)
+    if ips is not None:
+        return dns, ips
+
+    if aiodns is None:
+        # dig +short 不输出 TTL，使用默认值
+        ips = await dig_query(domain, dns)
+        dns_cache_set(domain, dns, ips, DNS_FALLBACK_TTL if ips else DNS_ERROR_TTL)
+        return dns, ips
 
-def http_head(ip: str, domain: str) -> bool:
-    """HTTP HEAD 请求测试"""
     try:
-        conn = socket.create_connection((ip, 80), timeout=TIMEOUT)
-        request = f"HEAD / HTTP/1.1\r\nHost: {domain}\r\nConnection: close\r\n\r\n".encode()
-        conn.send(request)
-        resp = conn.recv(50)
-        return resp.startswith(b"HTTP")
+        result = await get_resolver(dns).query(domain, "A")
     except Exception:
-        return False
+        dns_cache_set(domain, dns, [], DNS_ERROR_TTL)
+        return dns, []
 
+    ips = [r.host for r in result]
+    dns_cache_set(domain, dns, ips, min((r.ttl for r in result), default=DNS_ERROR_TTL))
+    return dns, ips
 
-# -----------------------
-# 异步工具函数
-# -----------------------
 
-async def async_dig_query(domain: str, dns: str) -> tuple[str, list]:
-    """异步 DNS 查询"""
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(executor, dig_query, domain, dns)
-    return dns, result
+async def close_writer(writer: asyncio.StreamWriter):
+    """关闭连接，忽略关闭过程中的异常"""
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
 
 
 async def async_tcp_connect(ip: str, port: int) -> tuple[str, int, bool]:
     """异步 TCP 连接测试"""
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(executor, tcp_connect, ip, port)
-    return ip, port, result
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), TIMEOUT)
+    except Exception:
+        return ip, port, False
+
+    await close_writer(writer)
+    return ip, port, True
+
+
+async def tls_bio_handshake(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    tls: ssl.SSLObject,
+    incoming: ssl.MemoryBIO,
+    outgoing: ssl.MemoryBIO
+):
+    """在已建立的 TCP 连接上驱动 TLS 握手（loop.start_tls 不支持传入 session）"""
+    while True:
+        try:
+            tls.do_handshake()
+            break
+        except ssl.SSLWantReadError:
+            pass
+
+        writer.write(outgoing.read())
+        await writer.drain()
+
+        data = await reader.read(65536)
+        if data:
+            incoming.write(data)
+        else:
+            incoming.write_eof()
+
+    # 发送客户端 Finished
+    writer.write(outgoing.read())
+    await writer.drain()
+
+
+async def save_tls_session(
+    reader: asyncio.StreamReader,
+    tls: ssl.SSLObject,
+    incoming: ssl.MemoryBIO,
+    domain: str
+):
+    """缓存握手得到的 TLS 会话
+
+    TLS 1.3 的会话票据在握手完成后才下发，只在首次握手时短暂等待一次；
+    未收到票据的域名记为 None，之后不再等待。TLS 1.2 的会话握手完成即可复用。
+    """
+    if tls.session_reused:
+        return
+
+    session = tls.session
+    if tls.version() == "TLSv1.3" and not session.has_ticket:
+        if domain in _tls_sessions:
+            return
+        try:
+            incoming.write(await asyncio.wait_for(reader.read(65536), TLS_TICKET_WAIT))
+            tls.read()
+        except Exception:
+            pass
+        session = tls.session if tls.session.has_ticket else None
+
+    _tls_sessions[domain] = session
+    _tls_sessions.move_to_end(domain)
+    while len(_tls_sessions) > TLS_SESSION_CACHE_SIZE:
+        _tls_sessions.popitem(last=False)
 
 
 async def async_tls_handshake(domain: str) -> Union[str, bool]:
-    """异步 TLS 握手测试"""
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(executor, tls_handshake, domain)
-    return result
+    """异步 TLS 握手测试（复用同一域名已缓存的 TLS 会话）"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(domain, 443), TIMEOUT)
+    except Exception:
+        return False
+
+    try:
+        try:
+            incoming = ssl.MemoryBIO()
+            outgoing = ssl.MemoryBIO()
+            tls = _TLS_CTX.wrap_bio(
+                incoming, outgoing,
+                server_hostname=domain,
+                session=_tls_sessions.get(domain)
+            )
+            await asyncio.wait_for(tls_bio_handshake(reader, writer, tls, incoming, outgoing), TIMEOUT)
+        except ssl.SSLError:
+            return "TLS-Reset"
+        except Exception:
+            return False
+
+        # 会话缓存失败不影响握手结果
+        try:
+            await save_tls_session(reader, tls, incoming, domain)
+        except Exception:
+            pass
+        return True
+    finally:
+        # 只关心握手结果，直接断开，不等待 TLS close_notify
+        writer.transport.abort()
+
+
+def build_http_head(domain: str) -> bytes:
+    """构造 HTTP HEAD 请求（每次检测只构造一次）"""
+    return b"HEAD / HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n" % domain.encode()
+
+
+async def async_http_head(ip: str, request: bytes) -> tuple[str, bool]:
+    """异步 HTTP HEAD 请求测试（只读取状态行开头的 5 个字节）"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, 80), TIMEOUT)
+    except Exception:
+        return ip, False
+
+    try:
+        writer.write(request)
+        await writer.drain()
+        prefix = await asyncio.wait_for(reader.readexactly(5), TIMEOUT)
+        return ip, prefix == b"HTTP/"
+    except Exception:
+        return ip, False
+    finally:
+        await close_writer(writer)
+
+
+async def iter_dns_answers(domain: str, thorough: bool = False):
+    """并发查询所有 DNS 服务器，按返回先后逐个产出 (name, ips)
+
+    thorough 为 False 时，至少两个服务器返回相同的非空结果（或首个非空结果返回且距开始超过 TIMEOUT/2）即提前结束；
+    为 True 时等待所有 DNS 服务器返回。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TIMEOUT / 2
+    tasks = {
+        asyncio.ensure_future(async_dig_query(domain, dns)): name
+        for name, dns in TEST_DNS.items()
+    }
+    pending = set(tasks)
+    collected = 0
+    answers = set()
+
+    try:
+        while pending:
+            timeout = max(0, deadline - loop.time()) if collected and not thorough else None
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                break
+
+            for task in done:
+                _, ips = task.result()
+                # 空结果（查询失败或超时）不参与一致性判断
+                if ips:
+                    collected += 1
+                    answers.add(frozenset(ips))
+                yield tasks[task], ips
+
+            if not thorough and collected >= 2 and len(answers) < 2:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
 
+async def probe_ip(ip: str, http_request: bytes, domain_tls) -> dict:
+    """对单个 IP 执行 TCP 测试，端口连通后继续 TLS / HTTP 测试
 
-async def async_http_head(ip: str, domain: str) -> tuple[str, bool]:
-    """异步 HTTP HEAD 请求测试"""
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(executor, http_head, ip, domain)
-    return ip, result
+    TLS 握手连接的是域名本身（与 IP 无关），domain_tls() 返回本次检测共享的握手结果。
+    """
+    tcp_results = await asyncio.gather(*[async_tcp_connect(ip, port) for port in TEST_PORTS])
+    conn = {f"tcp_{port}": result for _, port, result in tcp_results}
+
+    tasks = {}
+    # 只有 TCP 443 通的情况下才测试 TLS
+    if conn.get("tcp_443", False):
+        tasks["tls"] = asyncio.shield(domain_tls())
+
+    # 只有 TCP 80 通的情况下才测试 HTTP
+    if conn.get("tcp_80", False):
+        tasks["http"] = async_http_head(ip, http_request)
+
+    for key, result in zip(tasks, await asyncio.gather(*tasks.values())):
+        conn[key] = result[1] if key == "http" else result
+
+    return conn
 
 
 # -----------------------
 # 主检测函数（并发版本）
 # -----------------------
 
-async def check_domain(domain: str) -> dict:
-    """检测域名是否被墙（并发执行）"""
+async def check_domain(domain: str, thorough: bool = False) -> dict:
+    """检测域名是否被墙（并发执行）
+
+    每个 DNS 服务器返回后立即对新出现的 IP 发起 TCP / TLS / HTTP 测试，无需等待其余 DNS 服务器。
+    thorough 为 False 时 DNS 检测在结果一致后提前结束；为 True 时等待所有 DNS 服务器返回。
+    """
     start_time = time.time()
     report = {
         "domain": domain,
@@ -154,18 +439,32 @@ async def check_domain(domain: str) -> dict:
         "timestamp": time.time()
     }
 
-    # ---- 并发执行 DNS 检测 ----
-    dns_tasks = [(name, async_dig_query(domain, dns)) for name, dns in TEST_DNS.items()]
-    dns_results = await asyncio.gather(*[task[1] for task in dns_tasks])
-    
+    # ---- DNS 检测与连通性测试重叠执行 ----
     dns_dict = {}
-    for (name, _), (dns_ip, ips) in zip(dns_tasks, dns_results):
-        dns_dict[name] = ips
-    
-    report["dns"] = dns_dict
+    probes = {}
+    http_request = build_http_head(domain)
+    tls_task = None
+
+    def domain_tls() -> asyncio.Task:
+        # 同一次检测只握手一次，所有 TCP 443 连通的 IP 共享结果
+        nonlocal tls_task
+        if tls_task is None:
+            tls_task = tg.create_task(async_tls_handshake(domain))
+        return tls_task
+
+    async with asyncio.TaskGroup() as tg:
+        async with contextlib.aclosing(iter_dns_answers(domain, thorough)) as answers:
+            async for name, ips in answers:
+                dns_dict[name] = ips
+                for ip in ips:
+                    if ip not in probes and len(probes) < MAX_PROBE_IPS:
+                        probes[ip] = tg.create_task(probe_ip(ip, http_request, domain_tls))
+
+    # 保持与 TEST_DNS 相同的顺序
+    report["dns"] = {name: dns_dict[name] for name in TEST_DNS if name in dns_dict}
 
     # ---- 分析 DNS 是否污染 ----
-    all_ips = set(ip for ips in dns_dict.values() for ip in ips)
+    all_ips = set().union(*dns_dict.values())
     report["summary"]["all_ips"] = list(all_ips)
     report["summary"]["dns_pollution"] = len(all_ips) > 1
     report["summary"]["dns_status"] = "疑似 DNS 污染" if len(all_ips) > 1 else "DNS 解析一致"
@@ -175,45 +474,7 @@ async def check_domain(domain: str) -> dict:
         report["summary"]["elapsed_time"] = time.time() - start_time
         return report
 
-    # ---- 并发执行 TCP 连接测试 ----
-    tcp_tasks = []
-    for ip in all_ips:
-        for port in TEST_PORTS:
-            tcp_tasks.append(async_tcp_connect(ip, port))
-    
-    tcp_results = await asyncio.gather(*tcp_tasks)
-    
-    # 组织 TCP 结果
-    for ip in all_ips:
-        report["connectivity"][ip] = {}
-    
-    for ip, port, result in tcp_results:
-        report["connectivity"][ip][f"tcp_{port}"] = result
-
-    # ---- 并发执行 TLS 和 HTTP 测试 ----
-    tls_tasks = []
-    http_tasks = []
-    
-    for ip in all_ips:
-        # 只有 TCP 443 通的情况下才测试 TLS
-        if report["connectivity"][ip].get("tcp_443", False):
-            tls_tasks.append((ip, async_tls_handshake(domain)))
-        
-        # 只有 TCP 80 通的情况下才测试 HTTP
-        if report["connectivity"][ip].get("tcp_80", False):
-            http_tasks.append((ip, async_http_head(ip, domain)))
-    
-    # 并发执行 TLS 测试
-    if tls_tasks:
-        tls_results = await asyncio.gather(*[task[1] for task in tls_tasks])
-        for (ip, _), result in zip(tls_tasks, tls_results):
-            report["connectivity"][ip]["tls"] = result
-    
-    # 并发执行 HTTP 测试
-    if http_tasks:
-        http_results = await asyncio.gather(*[task[1] for task in http_tasks])
-        for (ip, _), result in zip(http_tasks, http_results):
-            report["connectivity"][ip]["http"] = result
+    report["connectivity"] = {ip: task.result() for ip, task in probes.items()}
 
     # ---- 生成综合判断 ----
     blocked_indicators = []
@@ -246,6 +507,19 @@ async def check_domain(domain: str) -> dict:
     return report
 
 
+async def check_domain_coalesced(domain: str, thorough: bool = False) -> dict:
+    """合并同一域名的并发检测请求"""
+    key = (domain, thorough)
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(check_domain(domain, thorough))
+        _inflight[key] = fut
+        fut.add_done_callback(lambda _: _inflight.pop(key, None))
+
+    # 某个请求被取消时不影响其他等待同一结果的请求
+    return await asyncio.shield(fut)
+
+
 # -----------------------
 # API 路由
 # -----------------------
@@ -264,28 +538,40 @@ async def root():
 
 
 @app.get("/check")
-async def check_domain_get(domain: str = Query(..., description="要检测的域名", example="google.com")):
+@limiter.limit(RATE_LIMIT)
+async def check_domain_get(
+    request: Request,
+    domain: str = Query(..., description="要检测的域名", example="google.com"),
+    thorough: bool = Query(False, description="等待所有 DNS 服务器返回（完整的 DNS 污染检测）")
+):
     """GET 方式检测域名"""
     if not domain or not domain.strip():
         raise HTTPException(status_code=400, detail="域名参数不能为空")
     
-    domain = domain.strip()
+    domain = normalize_domain(domain.strip())
+    if domain is None:
+        raise HTTPException(status_code=400, detail="域名格式不正确")
+
     try:
-        result = await check_domain(domain)
+        result = await check_domain_coalesced(domain, thorough)
         return JSONResponse(content=result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"检测过程中发生错误: {str(e)}")
 
 
 @app.post("/check")
-async def check_domain_post(request: DomainRequest):
+@limiter.limit(RATE_LIMIT)
+async def check_domain_post(request: Request, body: DomainRequest):
     """POST 方式检测域名"""
-    domain = request.domain.strip()
+    domain = body.domain.strip()
     if not domain:
         raise HTTPException(status_code=400, detail="域名参数不能为空")
-    
+    domain = normalize_domain(domain)
+    if domain is None:
+        raise HTTPException(status_code=400, detail="域名格式不正确")
+
     try:
-        result = await check_domain(domain)
+        result = await check_domain_coalesced(domain, body.thorough)
         return JSONResponse(content=result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"检测过程中发生错误: {str(e)}")
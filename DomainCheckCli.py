@@ -7,10 +7,15 @@ Domain Firewall Check Script
 """
 
 import socket
+import re
 import ssl
-import subprocess
+import asyncio
 import json
-import time
+
+try:
+    import aiodns
+except ImportError:  # 未安装 aiodns 时回退到 dig 子进程
+    aiodns = None
 
 # -----------------------
 # 配置区域
@@ -20,89 +25,196 @@ TEST_DNS = {
     "Google(8.8.8.8)": "8.8.8.8",
     "Cloudflare(1.1.1.1)": "1.1.1.1",
     "Ali(223.5.5.5)": "223.5.5.5",
-    "114DNS(114.114.114.114)": "114.114.114.114"
+    "114DNS(114.114.114.114)": "114.114.114.114",
+    "System(本机)": None
 }
 
-TEST_PORTS = [80, 443]
+TEST_PORTS = (80, 443)
 
 TIMEOUT = 4
 
+# 域名格式（IDNA 编码后校验）
+_DOMAIN_RE = re.compile(
+    r"^(?=.{1,253}$)(?!-)[A-Za-z0-9-]{1,63}(?<!-)(\.(?!-)[A-Za-z0-9-]{1,63}(?<!-))+$"
+)
+
+# TLS 上下文（创建时需加载系统 CA 证书，全局复用）
+_TLS_CTX = ssl.create_default_context()
+
+HTTP_HEAD_REQUEST = b"HEAD / HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n"
+
 
 # -----------------------
 # 工具函数
 # -----------------------
 
-def dig_query(domain, dns):
+def normalize_domain(domain):
+    domain = domain.lower()
+    if domain.endswith("."):
+        domain = domain[:-1]
+    try:
+        ascii_domain = domain.encode("idna").decode("ascii")
+        # 内置 idna 编解码器遵循 IDNA2003，会把 ß、ς 等字符改写成其他字母（ß.de → ss.de），
+        # 非 ASCII 标签转换后无法还原为原输入的直接拒绝，避免检测到另一个域名
+        for label, ascii_label in zip(domain.split("."), ascii_domain.split(".")):
+            if not label.isascii() and ascii_label.encode("ascii").decode("idna") != label:
+                return None
+    except Exception:
+        return None
+    return ascii_domain if _DOMAIN_RE.match(ascii_domain) else None
+
+
+async def dig_query(domain, dns):
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "dig", "+short", domain, "@%s" % dns,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+    except Exception:
+        return []
+
+    try:
+        output, _ = await asyncio.wait_for(proc.communicate(), TIMEOUT)
+    except Exception:
+        return []
+    finally:
+        # 超时或被取消（DNS 检测提前结束）时结束 dig 进程
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+
+    return [r for r in output.decode().strip().split("\n") if r]
+
+
+async def system_query(domain):
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await asyncio.wait_for(
+            loop.getaddrinfo(domain, 443, family=socket.AF_INET, type=socket.SOCK_STREAM),
+            TIMEOUT
+        )
+    except Exception:
+        return []
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+
+async def async_dig_query(domain, dns):
+    if dns is None:
+        return await system_query(domain)
+
+    if aiodns is None:
+        return await dig_query(domain, dns)
+
     try:
-        result = subprocess.check_output(
-            ["dig", "+short", domain, "@%s" % dns],
-            stderr=subprocess.STDOUT,
-            timeout=TIMEOUT
-        ).decode().strip().split("\n")
-        return [r for r in result if r]
+        # run() 每次调用 asyncio.run 都会创建新的事件循环，解析器随查询创建，不跨事件循环复用
+        resolver = aiodns.DNSResolver(nameservers=[dns], timeout=TIMEOUT, tries=1)
+        result = await resolver.query(domain, "A")
+        return [r.host for r in result]
     except Exception:
         return []
 
 
-def tcp_connect(ip, port):
+async def dns_query_all(domain):
+    results = await asyncio.gather(
+        *[async_dig_query(domain, dns) for dns in TEST_DNS.values()]
+    )
+    return dict(zip(TEST_DNS, results))
+
+
+async def close_writer(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+
+async def tcp_connect(ip, port):
     try:
-        with socket.create_connection((ip, port), timeout=TIMEOUT):
-            return True
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), TIMEOUT)
     except Exception:
         return False
 
+    await close_writer(writer)
+    return True
+
 
-def tls_handshake(domain):
+async def tls_handshake(domain):
     try:
-        ctx = ssl.create_default_context()
-        with ctx.wrap_socket(socket.socket(), server_hostname=domain) as s:
-            s.settimeout(TIMEOUT)
-            s.connect((domain, 443))
-            s.do_handshake()
-        return True
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(domain, 443, ssl=_TLS_CTX, server_hostname=domain),
+            TIMEOUT
+        )
     except ssl.SSLError:
         return "TLS-Reset"
     except Exception:
         return False
 
+    # 只关心握手结果，直接断开
+    writer.transport.abort()
+    return True
+
+
+async def http_head(ip):
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, 80), TIMEOUT)
+    except Exception:
+        return False
 
-def http_head(ip):
     try:
-        conn = socket.create_connection((ip, 80), timeout=TIMEOUT)
-        request = b"HEAD / HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n"
-        conn.send(request)
-        resp = conn.recv(50)
-        return resp.startswith(b"HTTP")
+        writer.write(HTTP_HEAD_REQUEST)
+        await writer.drain()
+        prefix = await asyncio.wait_for(reader.readexactly(5), TIMEOUT)
+        return prefix == b"HTTP/"
     except Exception:
         return False
+    finally:
+        await close_writer(writer)
+
+
+async def probe_ip(ip, domain):
+    # TCP 80/443
+    tcp = dict(zip(TEST_PORTS, await asyncio.gather(*[tcp_connect(ip, p) for p in TEST_PORTS])))
+    result = {f"tcp_{p}": ok for p, ok in tcp.items()}
+
+    # TLS / HTTP（仅在对应端口连通时测试）
+    checks = {}
+    if tcp[443]:
+        checks["tls"] = tls_handshake(domain)
+    if tcp[80]:
+        checks["http"] = http_head(ip)
+    result.update(zip(checks, await asyncio.gather(*checks.values())))
+
+    return result
 
 
 # -----------------------
 # 主函数
 # -----------------------
 
-def run(domain):
+async def run_async(domain):
     print("\n============================")
     print("  域名检测工具")
     print("============================\n")
     print(f"目标域名：{domain}")
     print("开始检测...\n")
-    time.sleep(0.8)
+    await asyncio.sleep(0.8)
 
     report = {"domain": domain, "dns": {}, "connectivity": {}}
 
     # ---- DNS 检测 ----
     print("🔍 DNS 检测中...\n")
-    dns_results = {}
-    for name, dns in TEST_DNS.items():
-        ips = dig_query(domain, dns)
-        dns_results[name] = ips
+    dns_results = await dns_query_all(domain)
+    for name, ips in dns_results.items():
         print(f"  {name:<20} => {ips}")
 
     report["dns"] = dns_results
 
     # ---- 分析 DNS 是否污染 ----
-    all_ips = set(ip for ips in dns_results.values() for ip in ips)
+    all_ips = set().union(*dns_results.values())
     if len(all_ips) > 1:
         print("\n⚠️ 检测到不同 DNS 解析结果 → 疑似 DNS 污染")
     else:
@@ -116,20 +228,18 @@ def run(domain):
         print("❌ 无法获得有效解析结果，后续无法继续测试。")
         return report
 
-    for ip in ips:
+    # 所有 IP 并发测试，完成后按顺序输出
+    results = await asyncio.gather(*[probe_ip(ip, domain) for ip in ips])
+
+    for ip, conn in zip(ips, results):
         print(f"🧪 测试 IP: {ip}")
-        report["connectivity"][ip] = {}
+        report["connectivity"][ip] = conn
 
-        # TCP 80/443
         for p in TEST_PORTS:
-            ok = tcp_connect(ip, p)
-            report["connectivity"][ip][f"tcp_{p}"] = ok
-            print(f"  TCP {p:<3}: {'✔ 通' if ok else '❌ 不通'}")
-
-        # TLS
-        if tcp_connect(ip, 443):
-            tls = tls_handshake(domain)
-            report["connectivity"][ip]["tls"] = tls
+            print(f"  TCP {p:<3}: {'✔ 通' if conn[f'tcp_{p}'] else '❌ 不通'}")
+
+        if "tls" in conn:
+            tls = conn["tls"]
             if tls is True:
                 print("  TLS : ✔ 握手成功")
             elif tls == "TLS-Reset":
@@ -137,11 +247,8 @@ def run(domain):
             else:
                 print("  TLS : ❌ 握手失败")
 
-        # HTTP
-        if tcp_connect(ip, 80):
-            head = http_head(ip)
-            report["connectivity"][ip]["http"] = head
-            print(f"  HTTP: {'✔ 返回正常' if head else '❌ 无响应'}")
+        if "http" in conn:
+            print(f"  HTTP: {'✔ 返回正常' if conn['http'] else '❌ 无响应'}")
 
         print()
 
@@ -154,10 +261,17 @@ def run(domain):
     return report
 
 
+def run(domain):
+    return asyncio.run(run_async(domain))
+
+
 # -----------------------
 # 入口
 # -----------------------
 
 if __name__ == "__main__":
-    domain = input("请输入要检测的域名：").strip()
-    run(domain)
+    domain = normalize_domain(input("请输入要检测的域名：").strip())
+    if domain is not None:
+        run(domain)
+    else:
+        print("❌ 域名格式不正确")
@@ -1,100 +1,262 @@
 import sys
 import json
 import socket
+import re
 import ssl
 import aiohttp
 import asyncio
-import subprocess
+import time
+import qasync
+from collections import OrderedDict
 from PyQt5 import QtWidgets, QtCore, QtGui
 
+try:
+    import aiodns
+except ImportError:  # 未安装 aiodns 时回退到 dig 子进程
+    aiodns = None
+
 
 TEST_DNS = {
     "Google(8.8.8.8)": "8.8.8.8",
     "Cloudflare(1.1.1.1)": "1.1.1.1",
     "AliDNS(223.5.5.5)": "223.5.5.5",
-    "114DNS(114.114.114.114)": "114.114.114.114"
+    "114DNS(114.114.114.114)": "114.114.114.114",
+    "System(本机)": None
 }
 
-TEST_PORTS = [80, 443]
+TEST_PORTS = (80, 443)
 TIMEOUT = 4
 
+# 域名格式（IDNA 编码后校验）
+_DOMAIN_RE = re.compile(
+    r"^(?=.{1,253}$)(?!-)[A-Za-z0-9-]{1,63}(?<!-)(\.(?!-)[A-Za-z0-9-]{1,63}(?<!-))+$"
+)
+
+# TLS 上下文（创建时需加载系统 CA 证书，全局复用）
+_TLS_CTX = ssl.create_default_context()
+
+DNS_CACHE_SIZE = 256
+DNS_ERROR_TTL = 0.15
+DNS_FALLBACK_TTL = 60
+
 OVERSEAS_APIS = [
-    "http://localhost:8000/check?domain=",
+    "http://localhost:8000/check?thorough=true&domain=",
 ]
 
+# (domain, dns) -> (过期时间, IP 列表)，重复检测同一域名时直接命中
+_dns_cache = OrderedDict()
+
+# 每个 DNS 服务器对应一个 aiodns 解析器，便于并发查询
+_resolvers = {}
+
+
+def normalize_domain(domain):
+    domain = domain.lower()
+    if domain.endswith("."):
+        domain = domain[:-1]
+    try:
+        ascii_domain = domain.encode("idna").decode("ascii")
+        # 内置 idna 编解码器遵循 IDNA2003，会把 ß、ς 等字符改写成其他字母（ß.de → ss.de），
+        # 非 ASCII 标签转换后无法还原为原输入的直接拒绝，避免检测到另一个域名
+        for label, ascii_label in zip(domain.split("."), ascii_domain.split(".")):
+            if not label.isascii() and ascii_label.encode("ascii").decode("idna") != label:
+                return None
+    except:
+        return None
+    return ascii_domain if _DOMAIN_RE.match(ascii_domain) else None
+
+
+def dns_cache_get(domain, dns):
+    key = (domain, dns)
+    entry = _dns_cache.get(key)
+    if entry is None:
+        return None
+    expiry, ips = entry
+    if expiry <= time.monotonic():
+        _dns_cache.pop(key, None)
+        return None
+    _dns_cache.move_to_end(key)
+    return ips
+
+
+def dns_cache_set(domain, dns, ips, ttl):
+    key = (domain, dns)
+    _dns_cache[key] = (time.monotonic() + ttl, ips)
+    _dns_cache.move_to_end(key)
+    while len(_dns_cache) > DNS_CACHE_SIZE:
+        _dns_cache.popitem(last=False)
+
+
+def get_resolver(dns):
+    resolver = _resolvers.get(dns)
+    if resolver is None:
+        resolver = aiodns.DNSResolver(nameservers=[dns], timeout=TIMEOUT, tries=1)
+        _resolvers[dns] = resolver
+    return resolver
+
+
+async def dig_query(domain, dns):
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "dig", "+short", domain, "@%s" % dns,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+    except Exception:
+        return []
+
+    try:
+        output, _ = await asyncio.wait_for(proc.communicate(), TIMEOUT)
+    except Exception:
+        return []
+    finally:
+        # 超时或被取消（DNS 检测提前结束）时结束 dig 进程
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+
+    return [r for r in output.decode().strip().split("\n") if r]
+
+
+async def system_query(domain):
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await asyncio.wait_for(
+            loop.getaddrinfo(domain, 443, family=socket.AF_INET, type=socket.SOCK_STREAM),
+            TIMEOUT
+        )
+    except:
+        return []
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+
+async def async_dig_query(domain, dns):
+    if dns is None:
+        return await system_query(domain)
+
+    ips = dns_cache_get(domain, dns)
+    if ips is not None:
+        return ips
+
+    if aiodns is None:
+        # dig +short 不输出 TTL，使用默认值
+        ips = await dig_query(domain, dns)
+        dns_cache_set(domain, dns, ips, DNS_FALLBACK_TTL if ips else DNS_ERROR_TTL)
+        return ips
 
-def dig_query(domain, dns):
     try:
-        result = subprocess.check_output(
-            ["dig", "+short", domain, "@%s" % dns],
-            stderr=subprocess.STDOUT,
-            timeout=TIMEOUT
-        ).decode().strip().split("\n")
-        return [r for r in result if r]
+        result = await get_resolver(dns).query(domain, "A")
     except:
+        dns_cache_set(domain, dns, [], DNS_ERROR_TTL)
         return []
 
+    ips = [r.host for r in result]
+    dns_cache_set(domain, dns, ips, min((r.ttl for r in result), default=DNS_ERROR_TTL))
+    return ips
+
 
-def tcp_connect(ip, port):
+async def tcp_connect(ip, port):
     try:
-        with socket.create_connection((ip, port), timeout=TIMEOUT):
-            return True
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), TIMEOUT)
     except:
         return False
 
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except:
+        pass
+    return True
+
 
-def tls_handshake(domain):
+async def tls_handshake(domain):
     try:
-        ctx = ssl.create_default_context()
-        with ctx.wrap_socket(socket.socket(), server_hostname=domain) as s:
-            s.settimeout(TIMEOUT)
-            s.connect((domain, 443))
-            s.do_handshake()
-        return True
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(domain, 443, ssl=_TLS_CTX, server_hostname=domain),
+            TIMEOUT
+        )
     except ssl.SSLError:
         return "TLS-Reset"
     except:
         return False
 
+    # 只关心握手结果，直接断开
+    writer.transport.abort()
+    return True
 
-class Worker(QtCore.QThread):
+
+class Worker(QtCore.QObject):
     finished = QtCore.pyqtSignal(dict, dict, dict)
 
+    # 所有 Worker 共用同一个 HTTP 会话，复用连接池中的 TCP/TLS 连接
+    _session = None
+
     def __init__(self, domain):
         super().__init__()
         self.domain = domain
 
+    @classmethod
+    def get_session(cls):
+        if cls._session is None or cls._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=50,
+                limit_per_host=10,
+                ttl_dns_cache=300,
+                keepalive_timeout=10,
+                resolver=aiohttp.AsyncResolver() if aiodns is not None else None
+            )
+            cls._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT+2)
+            )
+        return cls._session
+
+    @classmethod
+    async def close_session(cls):
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+
     async def async_overseas_test(self):
+        session = self.get_session()
+
         async def fetch(api):
             url = api + self.domain
-            async with aiohttp.ClientSession() as s:
-                try:
-                    async with s.get(url, timeout=TIMEOUT+2) as r:
-                        return await r.json()
-                except:
-                    return {"error": f"海外 API 不可达: {api}"}
+            try:
+                async with session.get(url) as r:
+                    return await r.json()
+            except:
+                return {"error": f"海外 API 不可达: {api}"}
 
         tasks = [fetch(api) for api in OVERSEAS_APIS]
         results = await asyncio.gather(*tasks)
         return dict(zip(OVERSEAS_APIS, results))
 
-    def local_test(self):
+    async def local_test(self):
         result = {"dns": {}, "connectivity": {}}
 
-        for name, dns in TEST_DNS.items():
-            ips = dig_query(self.domain, dns)
-            result["dns"][name] = ips
+        dns_results = await asyncio.gather(
+            *[async_dig_query(self.domain, dns) for dns in TEST_DNS.values()]
+        )
+        result["dns"] = dict(zip(TEST_DNS, dns_results))
 
-        all_ips = set(ip for ips in result["dns"].values() for ip in ips)
+        all_ips = set().union(*result["dns"].values())
         result["all_ips"] = list(all_ips)
 
+        tcp_coros = [tcp_connect(ip, p) for ip in all_ips for p in TEST_PORTS]
+        tcp_results = iter(await asyncio.gather(*tcp_coros))
         for ip in all_ips:
-            result["connectivity"][ip] = {}
-            for p in TEST_PORTS:
-                result["connectivity"][ip][f"tcp_{p}"] = tcp_connect(ip, p)
+            result["connectivity"][ip] = {f"tcp_{p}": next(tcp_results) for p in TEST_PORTS}
 
-            if tcp_connect(ip, 443):
-                result["connectivity"][ip]["tls"] = tls_handshake(self.domain)
+        # 所有 TCP 443 连通的 IP 同时进行 TLS 握手
+        tls_coros = {
+            ip: tls_handshake(self.domain)
+            for ip, conn in result["connectivity"].items() if conn["tcp_443"]
+        }
+        tls_results = await asyncio.gather(*tls_coros.values())
+        for ip, tls in zip(tls_coros, tls_results):
+            result["connectivity"][ip]["tls"] = tls
 
         return result
 
@@ -120,12 +282,9 @@ class Worker(QtCore.QThread):
 
         return report
 
-    def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        local = self.local_test()
-        overseas = loop.run_until_complete(self.async_overseas_test())
+    async def check(self):
+        # 国内检测与海外 API 查询在同一个事件循环上并发执行
+        local, overseas = await asyncio.gather(self.local_test(), self.async_overseas_test())
         summary = self.compare(local, overseas)
 
         self.finished.emit(local, overseas, summary)
@@ -151,6 +310,8 @@ class App(QtWidgets.QWidget):
         self.output.setReadOnly(True)
         self.layout.addWidget(self.output)
 
+        self.task = None
+
     def log(self, msg):
         self.output.append(msg)
         self.output.ensureCursorVisible()
@@ -160,13 +321,29 @@ class App(QtWidgets.QWidget):
         if not domain:
             self.log("❌ 请输入域名")
             return
+        domain = normalize_domain(domain)
+        if domain is None:
+            self.log("❌ 域名格式不正确")
+            return
+
+        # 上一次检测尚未结束时先取消，避免旧结果混入本次输出
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
 
         self.output.clear()
         self.log(f"开始检测：{domain}\n")
 
         self.worker = Worker(domain)
         self.worker.finished.connect(self.show_result)
-        self.worker.start()
+        self.task = asyncio.ensure_future(self.worker.check())
+        self.task.add_done_callback(self.on_task_done)
+
+    def on_task_done(self, task):
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self.log(f"❌ 检测失败：{exc!r}")
 
     def show_result(self, local, overseas, summary):
         self.log("=== 国内检测结果 ===")
@@ -190,6 +367,15 @@ class App(QtWidgets.QWidget):
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+
+    quit_event = asyncio.Event()
+    app.aboutToQuit.connect(quit_event.set)
+
     gui = App()
     gui.show()
-    sys.exit(app.exec_())
+
+    with loop:
+        loop.run_until_complete(quit_event.wait())
+        loop.run_until_complete(Worker.close_session())